@@ -0,0 +1,24 @@
+# gunicorn_conf.py (Конфигурация Gunicorn для продакшена на Render)
+#
+# Запуск:
+#   gunicorn -c gunicorn_conf.py main_app:app   (агент-источник)
+#   gunicorn -c gunicorn_conf.py main_bot:app   (Telegram-бот)
+
+import os
+
+# Адрес и порт, которые выдает Render
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# Потоковый воркер: держит keep-alive соединения и обслуживает параллельные
+# запросы, пока другие потоки ждут ответа gRPC от Тинькофф или OpenRouter
+worker_class = "gthread"
+# Кэш портфеля, объединение одновременных загрузок, кэши счета и инструментов, gRPC-клиент
+# и счетчики /cache/stats живут внутри процесса: каждый лишний воркер - это отдельная
+# загрузка портфеля за окно TTL и своя статистика. Поэтому по умолчанию один воркер,
+# а параллельность дают потоки (os.cpu_count() на Render показывает ядра хоста, а не лимит)
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+# Запросы почти все время ждут внешние API, поэтому потоков много больше, чем ядер
+threads = int(os.environ.get("GUNICORN_THREADS", "32"))
+
+# Сколько секунд держать простаивающее соединение открытым
+keepalive = 5
@@ -1,18 +1,119 @@
 # agent_source.py
 
 import os
+import io
+import csv
+import gzip
+import html
 import json
-from flask import Flask, jsonify
-import pandas as pd
+import atexit
+import time
+import hashlib
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import numpy as np
+from cachetools import TTLCache
+import orjson
+from flask import Flask, Response, request
+from flask_compress import Compress
+from werkzeug.http import is_resource_modified
 # ИСПОЛЬЗУЕМ НОВЫЙ ИСПРАВЛЕННЫЙ ИМПОРТ
 import tinkoff_invest as ti
 from tinkoff.invest.constants import ACCOUNT_TYPE_TINKOFF
 from tinkoff.invest.exceptions import RequestError # Корректный импорт исключения
+from tinkoff.invest.schemas import InstrumentIdType
+from grpc import StatusCode
 
 # Получение токена из переменных окружения
 TINKOFF_API_TOKEN = os.getenv("TINKOFF_API_TOKEN")
 
+# Время жизни закэшированного портфеля (в секундах)
+PORTFOLIO_TTL = int(os.getenv("PORTFOLIO_TTL", "15"))
+# Список счетов меняется редко, поэтому ID счета кэшируется надолго (в секундах)
+ACCOUNT_ID_TTL = 3600
+# Сколько ждать ответа на один вызов API Тинькофф (в секундах)
+TINKOFF_RPC_TIMEOUT = float(os.getenv("TINKOFF_RPC_TIMEOUT", "10"))
+# Сколько параллельный запрос ждет чужую загрузку портфеля: счета, портфель и инструменты
+# запрашиваются последовательно, плюс небольшой запас
+PORTFOLIO_WAIT_TIMEOUT = 3 * TINKOFF_RPC_TIMEOUT + 1
+
+# Порядок колонок в выгрузках портфеля
+PORTFOLIO_COLUMNS = ("ticker", "figi", "name", "balance", "currency", "price")
+# Колонки текстового отчета для Telegram-бота
+REPORT_COLUMNS = ("ticker", "name", "balance", "price", "currency")
+# Максимальная длина одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
 app = Flask(__name__)
+logger = app.logger
+
+# Сжатие ответов: JSON и CSV портфеля хорошо жмутся (повторяющиеся ключи, FIGI, валюты).
+# Тела /portfolio, /portfolio/csv и /api/v1/portfolio сжимаются заранее в make_snapshot и
+# отдаются уже с Content-Encoding, поэтому Flask-Compress их пропускает; на лету он сжимает
+# только остальные ответы (ошибки и /cache/stats)
+app.config["COMPRESS_ALGORITHM"] = "gzip"
+app.config["COMPRESS_MIN_SIZE"] = 500
+app.config["COMPRESS_MIMETYPES"] = ["application/json", "text/csv"]
+Compress(app)
+
+# --- Кэш портфеля ---
+# Частые запросы к /portfolio обслуживаются из памяти вместо повторных вызовов API
+_portfolio_cache = TTLCache(maxsize=8, ttl=PORTFOLIO_TTL)
+_portfolio_cache_lock = threading.Lock()
+_PORTFOLIO_CACHE_KEY = "portfolio"
+# Незавершенные загрузки: параллельные запросы ждут один и тот же Future
+_portfolio_inflight = {}
+# Счетчики для /cache/stats (изменяются под _portfolio_cache_lock)
+_cache_stats = {"hits": 0, "misses": 0, "coalesced": 0}
+
+
+# --- Общий клиент Тинькофф ---
+# Один gRPC-канал на процесс вместо установки соединения (TLS, HTTP/2) на каждый запрос
+_client_cm = None
+_client = None
+_client_lock = threading.Lock()
+# ID счета по хэшу токена: {хэш: (account_id, время получения)}
+_account_id_cache = {}
+# Пул потоков для параллельных запросов к API через общий gRPC-канал
+_pool = ThreadPoolExecutor(max_workers=8)
+# Справочные данные инструментов не меняются: {figi: (ticker, name)}
+_instrument_cache = {}
+
+
+class PortfolioError(Exception):
+    """Ожидаемая ошибка получения портфеля, текст которой отдается клиенту."""
+
+
+@dataclass(frozen=True)
+class PortfolioSnapshot:
+    """Загруженный портфель вместе с заранее закодированными телами ответов."""
+    portfolio: dict          # колонки портфеля: {имя колонки: список значений}
+    json_body: bytes
+    json_gzip: bytes
+    csv_body: bytes
+    csv_gzip: bytes
+    report_body: bytes      # JSON {"report": ...} для /api/v1/portfolio
+    report_gzip: bytes
+    etag: str
+    last_modified: datetime
+
+def accepts_gzip(body):
+    """Проверяет, стоит ли отдать клиенту gzip-версию тела (по Accept-Encoding и размеру)."""
+    return request.accept_encodings["gzip"] > 0 and len(body) >= app.config["COMPRESS_MIN_SIZE"]
+
+def precompressed_response(body, gzipped, use_gzip, mimetype):
+    """Формирует ответ из заранее закодированного тела или его gzip-версии."""
+    response = Response(gzipped if use_gzip else body, mimetype=mimetype)
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+def ojsonify(obj, status=200):
+    """Формирует JSON-ответ через orjson (быстрее стандартного jsonify)."""
+    return Response(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY), status=status, mimetype="application/json")
 
 # --- Маршрут для проверки работоспособности (Health Check) ---
 @app.route('/', methods=['GET'])
@@ -24,86 +125,326 @@ def health_check():
 @app.route('/portfolio', methods=['GET'])
 def portfolio_route():
     """Обрабатывает HTTP-запрос и возвращает данные портфеля в формате JSON."""
-    data, status_code = get_portfolio()
+    data, status_code, headers = get_portfolio(refresh=request.args.get("refresh") == "1")
     
-    # Если статус 200 (успех), возвращаем JSON-строку
-    if status_code == 200:
-        return data, status_code, {'Content-Type': 'application/json'}
-        
-    # Если ошибка, возвращаем JSON-словарь с кодом ошибки
-    return jsonify(data), status_code
+    # В случае ошибки data - словарь с описанием ошибки
+    if status_code != 200:
+        return ojsonify(data, status_code)
+    
+    # У сжатого и несжатого представлений разные сильные ETag
+    use_gzip = accepts_gzip(data.json_body)
+    etag = f"{data.etag}:gzip" if use_gzip else data.etag
+    
+    # Клиент уже получил эту версию портфеля - отвечаем 304 без тела
+    if not is_resource_modified(request.environ, etag=etag, last_modified=data.last_modified):
+        response = Response(status=304)
+        response.vary.add('Accept-Encoding')
+    else:
+        response = precompressed_response(data.json_body, data.json_gzip, use_gzip, "application/json")
+    response.set_etag(etag)
+    response.last_modified = data.last_modified
+    response.headers['Cache-Control'] = f'public, max-age={PORTFOLIO_TTL}'
+    response.headers.update(headers)
+    return response
 
-def get_portfolio():
-    """Получает портфель из Тинькофф Инвестиций, используя новый SDK."""
+# --- Маршрут для выгрузки портфеля в CSV ---
+@app.route('/portfolio/csv', methods=['GET'])
+def portfolio_csv_route():
+    """Возвращает данные портфеля в формате CSV."""
+    data, status_code, headers = get_portfolio(refresh=request.args.get("refresh") == "1")
+    if status_code != 200:
+        return ojsonify(data, status_code)
+    
+    response = precompressed_response(data.csv_body, data.csv_gzip, accepts_gzip(data.csv_body), "text/csv")
+    response.headers['Content-Disposition'] = 'attachment; filename=portfolio.csv'
+    response.headers.update(headers)
+    return response
+
+def render_csv(portfolio):
+    """Возвращает портфель в формате CSV (первая строка - заголовок)."""
+    # Позиции - плоская таблица, поэтому хватает стандартного модуля csv
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(PORTFOLIO_COLUMNS)
+    writer.writerows(zip(*(portfolio[c] for c in PORTFOLIO_COLUMNS)))
+    return buffer.getvalue()
+
+# --- Маршрут для отчета по портфелю (используется main_bot.py) ---
+@app.route('/api/v1/portfolio', methods=['GET'])
+def portfolio_api():
+    """Возвращает готовый текстовый отчет по портфелю в поле report."""
+    data, status_code, headers = get_portfolio(refresh=request.args.get("refresh") == "1")
+    if status_code != 200:
+        return ojsonify(data, status_code)
+    
+    response = precompressed_response(data.report_body, data.report_gzip,
+                                      accepts_gzip(data.report_body), "application/json")
+    response.headers.update(headers)
+    return response
+
+def portfolio_records(portfolio):
+    """Собирает из колонок портфеля список записей (по словарю на позицию)."""
+    return [dict(zip(PORTFOLIO_COLUMNS, row)) for row in zip(*(portfolio[c] for c in PORTFOLIO_COLUMNS))]
+
+def render_table(columns, cols):
+    """Строит текстовую таблицу с выровненными колонками из словаря колонок."""
+    cells = [[str(v) for v in columns[c]] for c in cols]
+    widths = [max([len(c)] + [len(v) for v in col]) for c, col in zip(cols, cells)]
+    lines = [" | ".join(c.ljust(w) for c, w in zip(cols, widths))]
+    lines.append("-+-".join("-" * w for w in widths))
+    lines += [" | ".join(v.ljust(w) for v, w in zip(row, widths)) for row in zip(*cells)]
+    return "\n".join(lines)
+
+def build_portfolio_report(portfolio):
+    """Формирует отчет по портфелю в HTML-разметке Telegram."""
+    if not portfolio["figi"]:
+        return "В портфеле нет позиций."
+    
+    # Форматируем цены один раз для всей колонки
+    columns = {**portfolio, "price": list(map("{:.2f}".format, portfolio["price"]))}
+    header, separator, *rows = html.escape(render_table(columns, REPORT_COLUMNS)).split("\n")
+    
+    # Отчет уходит одним сообщением: строки, не помещающиеся в лимит Telegram, отбрасываем
+    total = len(rows)
+    truncated_note = "\nПоказаны {} из {} позиций: отчет не помещается в одно сообщение."
+    budget = TELEGRAM_MESSAGE_LIMIT - len("<pre></pre>") - len(truncated_note.format(total, total))
+    length = len(header) + 1 + len(separator)
+    shown = 0
+    for row in rows:
+        length += 1 + len(row)
+        if length > budget:
+            break
+        shown += 1
+    
+    # Моноширинный блок, чтобы колонки таблицы не разъезжались
+    table = "\n".join([header, separator] + rows[:shown])
+    note = truncated_note.format(shown, total) if shown < total else ""
+    return f"<pre>{table}</pre>{note}"
+
+# --- Маршрут со статистикой кэша портфеля ---
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats_route():
+    """Возвращает счетчики попаданий и промахов кэша портфеля."""
+    with _portfolio_cache_lock:
+        stats = dict(_cache_stats, size=len(_portfolio_cache))
+    return ojsonify(dict(stats, ttl=PORTFOLIO_TTL))
+
+def get_portfolio(refresh=False):
+    """Возвращает PortfolioSnapshot (или словарь с ошибкой), статус и служебные заголовки ответа.
+
+    refresh=True (параметр запроса ?refresh=1) сбрасывает кэш и загружает портфель заново.
+    """
     if not TINKOFF_API_TOKEN:
-        return {"error": "TINKOFF_API_TOKEN не установлен. Проверьте переменные окружения."}, 500
+        return {"error": "TINKOFF_API_TOKEN не установлен. Проверьте переменные окружения."}, 500, {}
 
     try:
-        # Инициализация клиента НОВОГО SDK (используем ti.Client)
-        with ti.Client(TINKOFF_API_TOKEN) as client:
-            
-            # 1. Получаем список счетов
-            accounts_response = client.users.get_accounts()
-            accounts = accounts_response.accounts
-            
-            # Отфильтруем счета (например, оставим только брокерские счета Тинькофф)
-            tinkoff_accounts = [acc for acc in accounts if acc.type == ACCOUNT_TYPE_TINKOFF]
-            
-            if not tinkoff_accounts:
-                return {"error": "Нет доступных брокерских счетов Тинькофф для этого токена."}, 500
-                
-            # Используем ID первого счета
-            account_id = tinkoff_accounts[0].id
-            
-            # 2. Получаем портфель
-            portfolio_response = client.operations.get_portfolio(account_id=account_id)
-            
-            positions = []
-            for position in portfolio_response.positions:
-                
-                # В новом SDK данные о цене хранятся в формате Quotation (единицы и нано)
-                # Переводим в float для удобства
-                def quotation_to_float(quotation):
-                    return quotation.units + quotation.nano / 10**9
-
-                # Проверяем, что average_position_price не None, прежде чем его использовать
-                price_info = position.average_position_price
-                if price_info:
-                    current_price = quotation_to_float(price_info)
-                    currency = price_info.currency
-                else:
-                    # Если цена недоступна (например, для пустой позиции), ставим 0
-                    current_price = 0.0
-                    currency = "RUB" # Предположим базовую валюту
-                
-                positions.append({
-                    "ticker": position.ticker,
-                    "figi": position.figi,
-                    "name": position.name,
-                    # Баланс теперь в quantity
-                    "balance": quotation_to_float(position.quantity), 
-                    "currency": currency,
-                    "price": float(current_price),
-                })
-            
-            # Преобразование списка позиций в DataFrame и затем в JSON
-            df = pd.DataFrame(positions)
-            
-            return df.to_json(orient="records"), 200
+        snapshot, cache_hit = fetch_tinkoff_portfolio(refresh)
+        return snapshot, 200, {'X-Cache': 'HIT' if cache_hit else 'MISS'}
+
+    except PortfolioError as e:
+        return {"error": str(e)}, 500, {}
+
+    # API не ответило вовремя - отдаем ошибку, а не держим поток Gunicorn
+    except FutureTimeoutError:
+        error_msg = "API Тинькофф не ответило вовремя. Попробуйте позже."
+        logger.error(error_msg)
+        return {"error": error_msg}, 504, {}
 
     # Обработка ошибок, связанных с НОВЫМ API (RequestError)
     except RequestError as e: 
         error_msg = f"Ошибка API Тинькофф (RequestError): {e.metadata.message if e.metadata else e}"
-        app.logger.error(error_msg)
-        return {"error": error_msg}, 500
+        logger.error(error_msg)
+        return {"error": error_msg}, 500, {}
         
     # Обработка любых других непредвиденных ошибок
     except Exception as e:
         error_msg = f"Неизвестная ошибка при получении портфеля: {e}"
-        app.logger.error(error_msg)
-        return {"error": error_msg}, 500
+        logger.error(error_msg)
+        return {"error": error_msg}, 500, {}
+
+def fetch_tinkoff_portfolio(refresh=False):
+    """Возвращает PortfolioSnapshot и признак того, что он взят из кэша (TTL = PORTFOLIO_TTL).
+
+    Одновременные запросы при пустом кэше не дублируют вызовы API:
+    первый загружает портфель, остальные ждут его результат.
+    """
+    with _portfolio_cache_lock:
+        if refresh:
+            _portfolio_cache.pop(_PORTFOLIO_CACHE_KEY, None)
+        snapshot = _portfolio_cache.get(_PORTFOLIO_CACHE_KEY)
+        if snapshot is not None:
+            _cache_stats["hits"] += 1
+            return snapshot, True
+        future = _portfolio_inflight.get(_PORTFOLIO_CACHE_KEY)
+        is_leader = future is None
+        if is_leader:
+            _cache_stats["misses"] += 1
+            future = Future()
+            _portfolio_inflight[_PORTFOLIO_CACHE_KEY] = future
+        else:
+            _cache_stats["coalesced"] += 1
+
+    if not is_leader:
+        # Портфель уже загружается другим запросом
+        return future.result(timeout=PORTFOLIO_WAIT_TIMEOUT), True
+
+    try:
+        snapshot = make_snapshot(load_tinkoff_portfolio())
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        with _portfolio_cache_lock:
+            _portfolio_cache[_PORTFOLIO_CACHE_KEY] = snapshot
+        future.set_result(snapshot)
+        return snapshot, False
+    finally:
+        with _portfolio_cache_lock:
+            _portfolio_inflight.pop(_PORTFOLIO_CACHE_KEY, None)
+
+def make_snapshot(portfolio):
+    """Дополняет колонки портфеля готовыми телами ответов, сильным ETag и временем загрузки."""
+    payload = orjson.dumps(portfolio_records(portfolio), option=orjson.OPT_SERIALIZE_NUMPY)
+    csv_body = render_csv(portfolio).encode("utf-8")
+    report_body = orjson.dumps({"report": build_portfolio_report(portfolio)})
+    # Все представления (включая gzip) кодируются один раз на загрузку, а не на каждый запрос
+    return PortfolioSnapshot(
+        portfolio=portfolio,
+        json_body=payload,
+        json_gzip=gzip.compress(payload, mtime=0),
+        csv_body=csv_body,
+        csv_gzip=gzip.compress(csv_body, mtime=0),
+        report_body=report_body,
+        report_gzip=gzip.compress(report_body, mtime=0),
+        etag=hashlib.blake2b(payload, digest_size=8).hexdigest(),
+        # HTTP-даты имеют точность до секунды
+        last_modified=datetime.now(timezone.utc).replace(microsecond=0),
+    )
+
+def get_tinkoff_client():
+    """Возвращает общий для процесса клиент SDK, создавая его при первом обращении."""
+    global _client_cm, _client
+    with _client_lock:
+        if _client is None:
+            # Клиент создается лениво, уже в рабочем процессе Gunicorn (gRPC не переживает fork)
+            _client_cm = ti.Client(TINKOFF_API_TOKEN)
+            _client = _client_cm.__enter__()
+            atexit.register(_client_cm.__exit__, None, None, None)
+        return _client
+
+def call_api(method, **kwargs):
+    """Вызывает метод SDK в пуле и ждет ответ не дольше TINKOFF_RPC_TIMEOUT.
+
+    Синхронные методы SDK не принимают дедлайн, поэтому время ожидания ограничивается здесь.
+    """
+    return _pool.submit(method, **kwargs).result(timeout=TINKOFF_RPC_TIMEOUT)
+
+def _token_key():
+    """Короткий хэш токена - ключ кэша ID счета."""
+    return hashlib.sha256(TINKOFF_API_TOKEN.encode()).hexdigest()[:16]
+
+def get_account_id(client, refresh=False):
+    """Возвращает ID первого брокерского счета Тинькофф (кэшируется на ACCOUNT_ID_TTL)."""
+    token_key = _token_key()
+    cached = _account_id_cache.get(token_key)
+    if not refresh and cached and time.monotonic() - cached[1] < ACCOUNT_ID_TTL:
+        return cached[0]
+    
+    # 1. Получаем список счетов
+    accounts_response = call_api(client.users.get_accounts)
+    accounts = accounts_response.accounts
+    
+    # Отфильтруем счета (например, оставим только брокерские счета Тинькофф)
+    tinkoff_accounts = [acc for acc in accounts if acc.type == ACCOUNT_TYPE_TINKOFF]
+    
+    if not tinkoff_accounts:
+        raise PortfolioError("Нет доступных брокерских счетов Тинькофф для этого токена.")
+        
+    # Используем ID первого счета
+    account_id = tinkoff_accounts[0].id
+    _account_id_cache[token_key] = (account_id, time.monotonic())
+    return account_id
+
+def get_instruments(client, positions):
+    """Возвращает {figi: (ticker, name)}; неизвестные инструменты запрашиваются параллельно.
+
+    Если инструмент получить не удалось, подставляется тикер из позиции (или FIGI) без названия;
+    такая подстановка не кэшируется, и при следующей загрузке инструмент запрашивается снова.
+    """
+    # Новые версии SDK отдают тикер прямо в позиции портфеля
+    fallback_tickers = {position.figi: getattr(position, "ticker", "") for position in positions}
+    instruments = {figi: _instrument_cache[figi] for figi in fallback_tickers if figi in _instrument_cache}
+    futures = {
+        figi: _pool.submit(client.instruments.get_instrument_by,
+                           id_type=InstrumentIdType.INSTRUMENT_ID_TYPE_FIGI, id=figi)
+        for figi in fallback_tickers.keys() - instruments.keys()
+    }
+    # Все запросы идут параллельно, поэтому на них приходится один общий TINKOFF_RPC_TIMEOUT
+    deadline = time.monotonic() + TINKOFF_RPC_TIMEOUT
+    for figi, future in futures.items():
+        try:
+            instrument = future.result(timeout=max(0, deadline - time.monotonic())).instrument
+        except (RequestError, FutureTimeoutError) as e:
+            # Один недоступный инструмент не должен ломать весь портфель
+            logger.warning("Не удалось получить инструмент %s: %r", figi, e)
+            instruments[figi] = (fallback_tickers[figi] or figi, "")
+        else:
+            instruments[figi] = _instrument_cache[figi] = (instrument.ticker, instrument.name)
+    return instruments
+
+def quotations_to_floats(quotations):
+    """Переводит список Quotation/MoneyValue (единицы и нано) в массив float."""
+    n = len(quotations)
+    units = np.fromiter((q.units for q in quotations), dtype=np.int64, count=n)
+    nano = np.fromiter((q.nano for q in quotations), dtype=np.int64, count=n)
+    # Складываем в целых нано-единицах и делим один раз: одно округление вместо двух,
+    # поэтому 6.56 остается 6.56, а не 6.5600000000000005
+    return (units * 1_000_000_000 + nano) / 1e9
+
+def load_tinkoff_portfolio():
+    """Получает портфель из Тинькофф Инвестиций, используя новый SDK."""
+    client = get_tinkoff_client()
+    account_id = get_account_id(client)
+    
+    # 2. Получаем портфель
+    try:
+        portfolio_response = call_api(client.operations.get_portfolio, account_id=account_id)
+    except RequestError as e:
+        if e.code in (StatusCode.UNAUTHENTICATED, StatusCode.PERMISSION_DENIED):
+            # Права токена изменились - при следующем запросе список счетов будет получен заново
+            _account_id_cache.pop(_token_key(), None)
+        if e.code != StatusCode.NOT_FOUND:
+            raise
+        # Закэшированный счет больше не существует - запрашиваем список счетов заново
+        account_id = get_account_id(client, refresh=True)
+        portfolio_response = call_api(client.operations.get_portfolio, account_id=account_id)
+    
+    raw_positions = portfolio_response.positions
+    figis = [position.figi for position in raw_positions]
+    
+    # В позициях портфеля нет тикера и названия - берем их из справочника инструментов
+    instruments = get_instruments(client, raw_positions)
+    
+    # SDK всегда заполняет average_position_price (для пустой позиции - нулевым MoneyValue)
+    price_infos = [position.average_position_price for position in raw_positions]
+    # Баланс теперь в quantity; цены и балансы переводим в float сразу для всех позиций
+    balances = quotations_to_floats([position.quantity for position in raw_positions])
+    prices = quotations_to_floats(price_infos)
+    
+    # Портфель храним по колонкам: каждая колонка собирается одним проходом
+    return {
+        "ticker": [instruments[figi][0] for figi in figis],
+        "figi": figis,
+        "name": [instruments[figi][1] for figi in figis],
+        "balance": balances.tolist(),
+        # Если валюта не указана (например, для пустой позиции), предполагаем базовую валюту
+        "currency": [price_info.currency or "RUB" for price_info in price_infos],
+        "price": prices.tolist(),
+    }
 
-# Блок для запуска через Gunicorn на Render
+# Блок для локального запуска. В продакшене (Render) приложение запускается через Gunicorn:
+#   gunicorn -c gunicorn_conf.py main_app:app
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 5000))
-    app.run(host='0.0.0.0', port=port)
+    # threaded=True: Werkzeug обслуживает запросы параллельно и держит keep-alive (HTTP/1.1)
+    app.run(host='0.0.0.0', port=port, threaded=True)
@@ -2,8 +2,12 @@
 
 import os
 import requests # Нужен для HTTP-запросов к агенту
+from requests.adapters import HTTPAdapter
 import json
 import logging
+import threading
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request
 from telebot import types
 import telebot
@@ -16,8 +20,17 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "gpt-3.5-turbo")
 
+# Адрес, заголовки и системное сообщение OpenRouter не меняются за время жизни процесса
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_HEADERS = {
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "Content-Type": "application/json",
+}
+SYSTEM_MESSAGE = {"role": "system", "content": "Ты умный и вежливый Telegram-бот."}
+
 # АДРЕС НАШЕГО НОВОГО МИКРОСЕРВИСА
 AGENT_SOURCE_URL = os.getenv("AGENT_SOURCE_URL", "http://127.0.0.1:8000") 
+AGENT_PORTFOLIO_URL = f"{AGENT_SOURCE_URL}/api/v1/portfolio"
 
 # Проверка токенов (TINKOFF_API_TOKEN больше не нужен здесь!)
 if not TELEGRAM_TOKEN or not OPENROUTER_API_KEY:
@@ -25,67 +38,84 @@ if not TELEGRAM_TOKEN or not OPENROUTER_API_KEY:
     raise ValueError("Не найдены обязательные переменные среды для основного бота.")
 
 # --- 2. Инициализация ---
-bot = telebot.TeleBot(TELEGRAM_TOKEN, parse_mode='HTML')
+# threaded=False: обработчики выполняются в update_pool (см. telegram_webhook), а не во
+# встроенном пуле telebot из двух потоков с неограниченной очередью
+bot = telebot.TeleBot(TELEGRAM_TOKEN, parse_mode='HTML', threaded=False)
 app = Flask(__name__)
 SECRET_ROUTE = f"/{TELEGRAM_TOKEN}"
 
+# Общая HTTP-сессия: переиспользует keep-alive соединения с Агентом и OpenRouter
+# вместо нового TCP/TLS-соединения на каждый запрос
+http_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=2, pool_maxsize=32)
+http_session.mount("http://", _adapter)
+http_session.mount("https://", _adapter)
+
+# Пул для вызовов Telegram API, которые выполняются параллельно с основной работой обработчика
+chat_action_pool = ThreadPoolExecutor(max_workers=8)
+
+# Обновления обрабатываются в фоне, чтобы Telegram сразу получал ответ на webhook
+update_pool = ThreadPoolExecutor(max_workers=16)
+# Ограничение очереди: при переполнении отвечаем 503, и Telegram повторит доставку позже
+MAX_PENDING_UPDATES = 200
+_pending_updates = threading.BoundedSemaphore(MAX_PENDING_UPDATES)
+
 # --- 3. ФУНКЦИИ ---
 
 def get_portfolio_from_agent() -> str:
     """Запрашивает данные портфеля у микросервиса-источника по HTTP."""
-    url = f"{AGENT_SOURCE_URL}/api/v1/portfolio"
     try:
         # Делаем HTTP-запрос к нашему независимому агенту
-        response = requests.get(url, timeout=30)
+        response = http_session.get(AGENT_PORTFOLIO_URL, timeout=30)
         response.raise_for_status()
         # Получаем готовый, отформатированный отчет из JSON
-        return response.json().get("report", "⚠️ Ошибка: Агент не вернул отчет.")
+        return orjson.loads(response.content).get("report", "⚠️ Ошибка: Агент не вернул отчет.")
     except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка связи с Агентом-источником: {e}")
+        logger.error("Ошибка связи с Агентом-источником: %s", e)
         return f"⚠️ Ошибка: Не удалось связаться с Агентом по адресу {AGENT_SOURCE_URL}. Проверьте, запущен ли агент."
     except Exception as e:
         logger.exception("Критическая ошибка при запросе к Агенту")
         return f"⚠️ Неизвестная ошибка при запросе к Агенту: {e}"
 
-# get_openrouter_response остается без изменений
-
 def get_openrouter_response(prompt: str) -> str:
     """Отправляет запрос к OpenRouter."""
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-    }
     data = {
         "model": OPENROUTER_MODEL,
-        "messages": [
-            {"role": "system", "content": "Ты умный и вежливый Telegram-бот."},
-            {"role": "user", "content": prompt},
-        ],
+        "messages": [SYSTEM_MESSAGE, {"role": "user", "content": prompt}],
     }
     try:
-        response = requests.post(url, headers=headers, json=data, timeout=60)
+        # Тело кодируем и разбираем через orjson (Content-Type уже задан в OPENROUTER_HEADERS)
+        response = http_session.post(OPENROUTER_URL, headers=OPENROUTER_HEADERS, data=orjson.dumps(data), timeout=60)
         response.raise_for_status()
-        answer = response.json()["choices"][0]["message"]["content"]
+        answer = orjson.loads(response.content)["choices"][0]["message"]["content"]
         return answer.strip()
     except requests.exceptions.HTTPError as e:
         status = e.response.status_code if e.response else "?"
-        logger.error(f"HTTP Error from OpenRouter: {status}")
+        logger.error("HTTP Error from OpenRouter: %s", status)
         return f"⚠️ Ошибка OpenRouter (Код {status})."
     except Exception as e:
         logger.exception("Критическая ошибка при запросе к OpenRouter")
         return f"⚠️ Ошибка при обращении к OpenRouter: {e}"
 
+def wait_chat_action(typing):
+    """Дожидается отправки индикатора набора; его ошибки не мешают отправить ответ."""
+    try:
+        typing.result()
+    except Exception as e:
+        logger.warning("Не удалось отправить индикатор набора: %s", e)
+
 # --- 4. ОБРАБОТЧИКИ СООБЩЕНИЙ ---
 
 # ... (cmd_start и handle_message остаются) ...
 
 @bot.message_handler(commands=['portfolio'])
 def cmd_portfolio(message: types.Message):
-    logger.info(f"Команда /portfolio от {message.chat.id}")
-    bot.send_chat_action(message.chat.id, 'typing')
+    logger.info("Команда /portfolio от %s", message.chat.id)
+    # Индикатор набора отправляется параллельно с запросом к Агенту
+    typing = chat_action_pool.submit(bot.send_chat_action, message.chat.id, 'typing')
     # Вызываем новую функцию для запроса к отдельному сервису
     report = get_portfolio_from_agent() 
+    wait_chat_action(typing)  # индикатор должен уйти раньше ответа, иначе он повиснет после него
     bot.reply_to(message, report)
 
 # ... (Маршруты Flask и Запуск остаются) ...
@@ -96,9 +126,10 @@ def cmd_start(message: types.Message):
 
 @bot.message_handler(func=lambda message: True)
 def handle_message(message: types.Message):
-    logger.info(f"Сообщение для OpenRouter от {message.chat.id}")
-    bot.send_chat_action(message.chat.id, 'typing')
+    logger.info("Сообщение для OpenRouter от %s", message.chat.id)
+    typing = chat_action_pool.submit(bot.send_chat_action, message.chat.id, 'typing')
     reply = get_openrouter_response(message.text)
+    wait_chat_action(typing)
     bot.reply_to(message, reply)
 
 # --- 5. Маршруты Flask ---
@@ -114,8 +145,9 @@ def set_webhook():
         return "❌ RENDER_EXTERNAL_HOSTNAME не задан.", 500
     webhook_url = f"https://{hostname}{SECRET_ROUTE}"
     try:
-        result = bot.set_webhook(url=webhook_url)
-        logger.info(f"Webhook установлен: {result}, URL: {webhook_url}")
+        # Бот обрабатывает только сообщения - остальные типы обновлений Telegram не присылает
+        result = bot.set_webhook(url=webhook_url, allowed_updates=["message"])
+        logger.info("Webhook установлен: %s, URL: %s", result, webhook_url)
         return {"webhook_url": webhook_url, "result": result}, 200
     except Exception as e:
         logger.exception("Ошибка при установке Webhook")
@@ -124,10 +156,35 @@ def set_webhook():
 @app.route(SECRET_ROUTE, methods=["POST"])
 def telegram_webhook():
     """Главный маршрут для Telegram Webhook"""
-    bot.process_new_updates([telebot.types.Update.de_json(request.stream.read().decode("utf-8"))])
+    # Тело читаем байтами без сохранения в request: orjson сам декодирует UTF-8,
+    # а de_json принимает и готовый словарь
+    payload = orjson.loads(request.get_data(cache=False))
+    # Обновления без сообщения ни один обработчик не примет - не строим для них объекты telebot
+    if "message" in payload:
+        # Объект строим до того, как занять место в очереди: ошибка разбора не должна его удерживать
+        update = telebot.types.Update.de_json(payload)
+        if not _pending_updates.acquire(blocking=False):
+            logger.warning("Очередь обновлений переполнена (%s), просим Telegram повторить", MAX_PENDING_UPDATES)
+            return "", 503
+        try:
+            update_pool.submit(process_update, update)
+        except Exception:
+            _pending_updates.release()
+            raise
     return "", 200
 
+def process_update(update):
+    """Обрабатывает обновление в фоновом потоке и освобождает место в очереди."""
+    try:
+        bot.process_new_updates([update])
+    except Exception:
+        logger.exception("Ошибка при обработке обновления Telegram")
+    finally:
+        _pending_updates.release()
+
 # --- 6. Запуск приложения ---
+# Локальный запуск. В продакшене: gunicorn -c gunicorn_conf.py main_bot:app
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
-    app.run(host="0.0.0.0", port=port)
+    # threaded=True: Werkzeug обслуживает запросы параллельно и держит keep-alive (HTTP/1.1)
+    app.run(host="0.0.0.0", port=port, threaded=True)